@@ -7,6 +7,20 @@ from rich import print # for pretty CLI
 
 from helper import *
 
+
+# Auto-generated comment left by editors when they move a record to a different taxon
+_MOVED_RE = re.compile(r'Moved from .+\.\s*$', flags=re.I)
+
+# Accepted answers when screening a record
+_SCREEN_CMDS = frozenset(['y', 'yes', 'n', 'no', 'a', 'auto', 'q', 'quit'])
+
+# Template engine is shared by every export; compiled templates are also cached on disk between runs
+# (Templates don't change while the app is running, so skip checking them for edits on every lookup, and never evict them)
+template_env = jin.Environment(loader=jin.FileSystemLoader("templates/"),
+                               auto_reload=False, cache_size=-1,
+                               bytecode_cache=jin.FileSystemBytecodeCache())
+
+
 def screen_record(rec):
     log_comments(rec['comments'], rec['url'], "screen")
     # Prompt user
@@ -16,12 +30,13 @@ def screen_record(rec):
             "    [b cyan]a[/b cyan] -> [b cyan]auto[/b cyan]-export remaining records\n"
             "    [b cyan]q[/b cyan] -> skip remaining records and [b cyan]quit[/b cyan] \n>>> ", end="")
     cmd = input().strip().lower()
-    while cmd not in ['y', 'yes', 'n', 'no', 'a', 'auto', 'q', 'quit']:
+    while cmd not in _SCREEN_CMDS:
         print("[magenta]Command not recognized — please enter one of the options above[/magenta] \n>>> ", end="")
         cmd = input().strip().lower()
     print(" ")
     if cmd[0] == 'y':
-        print(f"> [i]Exporting {len(rec['comments'])} comment{'s' if len(rec['comments']) != 1 else ''}")
+        n = len(rec['comments'])
+        print(f"> [i]Exporting {n} comment{'s' if n != 1 else ''}")
         return rec
     elif cmd[0] == 'n':
         print("> [i]Record skipped")
@@ -39,22 +54,27 @@ def filter_record(rec):
         print("> No comments found at", rec['url'])
         return None
 
-    # Add some styling metadata to the comment
+    # Add some styling metadata to the comment, checking for highlights in the same pass
+    # (The comments only need to be sorted by highlight status if move comments are getting dropped)
+    split = args.ignore_moves == "always"
+    marked, unmarked = [], []
+    any_marked = False
     for c in rec['comments']:
         # Skip subject lines where the user didn't provide one so BG just filled it with body text
-        if c['body'][:len(c['subj'])] == c['subj']:
+        if c['body'].startswith(c['subj']):
             c['subj'] = ''
         # Highlight comments that have text other than (or in addition to) "Moved from ___"
-        c['highlight'] = not re.match('Moved from .+\.\s*$', c['body'], flags=re.I)
+        # (Most comments can be ruled out by their first few characters without running the full pattern)
+        c['highlight'] = c['body'][:11].lower() != 'moved from ' or not _MOVED_RE.match(c['body'])
+        any_marked = any_marked or c['highlight']
+        if split:
+            if c['highlight']: marked.append(c)
+            else: unmarked.append(c)
 
     # Filter record and/or specific comments based on comment content and user args
     if args.ignore_moves:
-        marked, unmarked = [], []
-        for c in rec['comments']:
-            if c['highlight']: marked.append(c)
-            else: unmarked.append(c)
         # If none are highlighted, discard the record
-        if not marked:
+        if not any_marked:
             log_comments(rec['comments'], rec['url'], "skip")
             return None
         if args.ignore_moves == "always":
@@ -104,8 +124,7 @@ def export_taxon(cfg):
     fname_out = "../comments/"+fname_out+".html"
 
     # Set up html template and process the records
-    env = jin.Environment(loader=jin.FileSystemLoader("templates/"))
-    template = env.get_template("comments.html")
+    template = template_env.get_template("comments.html")
     with open(fname_out, "w", encoding="utf-8") as fout:
         try:
             for sec_idx, sec in enumerate(context['sections']):
@@ -127,5 +146,6 @@ def export_taxon(cfg):
                 sec['records'] = filtered
         finally:
             # Always write to file, even if stopped by an error
-            fout.write(template.render(context))
+            # (Streamed in chunks rather than building the whole page as one string first)
+            template.stream(context).dump(fout)
 
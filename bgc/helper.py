@@ -5,6 +5,25 @@ from rich.panel import Panel
 from rich import print
 
 
+# Matches any HTML tag, for printing comment text as plain text
+_TAG_RE = re.compile(r"<[^<]+?>")
+
+# Summary line printed by log_comments() for each type of log
+_LOG_FMTS = {
+    "import": "> Saved {n} comment{s}",
+    "skip": "> [i]Skipping {n} comment{s} from {src}",
+    "screen": "> {n} comment{s} found on {src}",
+}
+
+
+def strip_tags(html: str) -> str:
+    """Returns the text of an HTML fragment with all tags removed"""
+    # Subject lines are usually plain text already
+    if "<" not in html:
+        return html
+    return _TAG_RE.sub("", html)
+
+
 # Log results for one processed record to the terminal
 def log_comments(comms: list, src: str, type="import", verbose=False) -> None:
     """Print an update to the terminal for this set of comments"""
@@ -12,15 +31,11 @@ def log_comments(comms: list, src: str, type="import", verbose=False) -> None:
         return
 
     # Log action being taken
-    s = 's' if len(comms) != 1 else ''
-    if type == "skip":
-        print(f"> [i]Skipping {len(comms)} comment{s} from {src}")
-    elif type == "screen":
-        print(f"> {len(comms)} comment{s} found on {src}")
-    elif type == "import":
-        print(f"> Saved {len(comms)} comment{s}")
-    else:
+    fmt = _LOG_FMTS.get(type)
+    if fmt is None:
         raise ValueError("Log type must be in ['import', 'skip', 'screen']")
+    n = len(comms)
+    print(fmt.format(n=n, s='s' if n != 1 else '', src=src))
 
     # In verbose mode, also log the comment text
     if verbose or type == "screen":
@@ -32,9 +47,9 @@ def log_comments(comms: list, src: str, type="import", verbose=False) -> None:
             style = "none"
         
         for c in comms:
-            body = re.sub("<[^<]+?>", "", c['body'])
-            subject = re.sub("<[^<]+?>", "", c['subj'])
-            byline = re.sub("<[^<]+?>", "", c['byline'])
+            body = strip_tags(c['body'])
+            subject = strip_tags(c['subj'])
+            byline = strip_tags(c['byline'])
             print(Padding(Panel(body, 
                                 title=subject, title_align="left", 
                                 subtitle=byline, subtitle_align="left", 
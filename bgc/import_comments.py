@@ -1,21 +1,56 @@
-from copy import copy
+from concurrent.futures import ThreadPoolExecutor # fetches the next record while the current one is processed
+from contextlib import closing
 from datetime import datetime as dt # for timestamping imports
 import json
 from math import ceil
 from os.path import exists # for checking if this will overwrite an existing file
 from os import mkdir
 import re
-from time import sleep # enforces crawl-delay
-from urllib.request import urlopen # grabs a page's HTML
+from threading import Event, Lock
+from time import monotonic, sleep # enforces crawl-delay
+from typing import Optional
 
 from bs4 import BeautifulSoup # creates a navigable parse tree from the HTML
 from bs4 import SoupStrainer
+import requests # grabs a page's HTML
+from requests.adapters import HTTPAdapter
 from rich import print
 from rich.prompt import Prompt, IntPrompt, Confirm, InvalidResponse
+import soupsieve as sv # precompiled CSS selectors
 
 from helper import *
 
 
+# Everything the scraper reads is inside div.col2, so skip building the rest of the page (header, sidebars, footer)
+_PAGE_CONTENT = SoupStrainer(class_="col2")
+# Last link in a set of breadcrumbs = the taxon that the page belongs to
+_TAXON_LINK = sv.compile(".bgpage-roots > a:last-of-type")
+# Guide menubar tabs: whichever one is currently open, and the link to the Images tab
+_SELECTED_TAB = sv.compile(".guide-menubar-selected")
+_IMG_TAB_LINK = sv.compile('a[href*="/bgimage"]')
+# Pager arrow that links to the next page of results
+_NEXT_PAGE = sv.compile('[alt="next page"]')
+# Ranks whose names get italicized
+_ITALIC_RANKS = frozenset(['genus', 'subgenus', 'species', 'subspecies'])
+# Any page that's part of the Guide
+_GUIDE_RE = re.compile(r"bugguide\.net/node/view/\d+")
+# Guide tabs that can be swapped for the Images tab by URL alone
+_WRONG_TAB_RE = re.compile(r"bugguide\.net/node/view/\d+/(tree|bgpage|bglink|bgref|data)")
+# Record offset in the pager's link to the last page
+_PAGER_FROM_RE = re.compile(r"(from=)(\d+)$")
+
+# Minimum number of seconds between the start of one page fetch and the next
+CRAWL_DELAY = 9
+_last_fetch = 0.0
+_fetch_lock = Lock()
+
+# Every page comes from the same host, so reuse one connection for all of them instead of reconnecting per page
+# (The pool only needs room for the few threads that fetch at once)
+session = requests.Session()
+session.headers["User-Agent"] = "bugguide-chat (https://github.com/ktwoods/bugguide-chat)"
+session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+
 # Section docstring, if necessary later
 """Contains metadata and records pulled from a section within a specific taxon
 
@@ -38,12 +73,15 @@ records : list[Record]
 
 
 # Get taxon rank and name text from breadcrumbs
-def get_taxon(soup) -> tuple:
+def get_taxon(soup, taxon_tag=None) -> tuple:
     """Returns (taxon_rank : str, taxon_name : str) based on the first set of breadcrumbs encountered
 
     Taxon rank is lowercased and comes from the link's title attribute. Some BugGuide categories are non-taxonomic (e.g. "unidentified larvae" or "mostly pale spp") and use title="No Taxon", in which case this function returns "section" for taxon_rank
+
+    If the caller has already looked up the last link in the breadcrumbs, it can be passed in as taxon_tag to skip searching the soup again
     """
-    taxon_tag = soup.find(class_="bgpage-roots").find_all("a")[-1]
+    if taxon_tag is None:
+        taxon_tag = _TAXON_LINK.select_one(soup)
     taxon_rank = taxon_tag['title'].lower() if taxon_tag['title'] != 'No Taxon' else 'section'
     taxon = taxon_tag.get_text()
     return taxon_rank, taxon
@@ -100,16 +138,18 @@ def parse_record(soup) -> dict:
     rdict['url'] = f"https://bugguide.net/node/view/{url_node}"
     rdict['img'] = soup.find(class_="bgimage-image")["src"]
     # If one or both M/F symbols are present in title, replace symbol gif with text before decoding the Tag object
-    title_tag = copy(soup.find(class_="node-title"))
+    # (Edited in place rather than on a copy, since each record page gets its own throwaway soup)
+    title_tag = soup.find(class_="node-title")
     symbols = title_tag.find_all("img")
+    sexes = ''
     if symbols:
         # The images have "Male"/"Female" alt text
-        title_tag.append(symbols[0]['alt'].lower())
-        title_tag.img.decompose()
+        sexes = symbols[0]['alt'].lower()
+        symbols[0].decompose()
         if len(symbols) == 2:
-            title_tag.append(' & ' + symbols[1]['alt'].lower())
-            title_tag.img.decompose()
-    rdict['title'] = title_tag.decode_contents().strip()
+            sexes += ' &amp; ' + symbols[1]['alt'].lower()
+            symbols[1].decompose()
+    rdict['title'] = (title_tag.decode_contents() + sexes).strip()
     # div.bgimage-where-when element is reliably present, even if it's empty
     rdict['metadata'] = soup.find(class_="bgimage-where-when").decode_contents().strip()
     # div.node-body element is absent if the user provided no description
@@ -124,10 +164,63 @@ def parse_record(soup) -> dict:
     return rdict
 
 
-def make_soup(url: str) -> BeautifulSoup:
+def wait_for_crawl_delay(stop: Optional[Event] = None) -> bool:
+    """Sleeps until CRAWL_DELAY seconds have passed since the previous page fetch started
+
+    Time already spent downloading and processing the previous page counts toward the delay, so this only waits for whatever is left
+
+    If a stop event is given and it gets set before the wait is over, returns False right away instead of clearing the next fetch to go ahead
+    """
+    global _last_fetch
+    with _fetch_lock:
+        wait = _last_fetch + CRAWL_DELAY - monotonic()
+        if stop is None:
+            if wait > 0:
+                sleep(wait)
+        elif stop.wait(max(wait, 0)):
+            return False
+        _last_fetch = monotonic()
+        return True
+
+
+def make_soup(url: str, stop: Optional[Event] = None) -> Optional[BeautifulSoup]:
+    """Fetches and parses the page at this URL, or returns None without fetching if the stop event is set while waiting out the crawl-delay
+
+    Only prefetch_soups() should pass a stop event; every other caller expects to always get a soup back
+    """
     # print("Making soup from", url)
-    html = urlopen(url).read().decode("utf-8")
-    return BeautifulSoup(html, "html.parser", parse_only=SoupStrainer(class_="col2"))
+    if not wait_for_crawl_delay(stop):
+        return None
+    resp = session.get(url, timeout=30)
+    resp.raise_for_status()
+    # Hand the raw bytes to the parser
+    # (BugGuide pages are always UTF-8, so tell the parser up front instead of making it sniff for the encoding)
+    return BeautifulSoup(resp.content, "lxml", parse_only=_PAGE_CONTENT, from_encoding="utf-8")
+
+
+def prefetch_soups(urls: list):
+    """Yields (url, soup) for each URL in order, fetching the next page in the background while the current one is being processed
+
+    Only one page is ever fetched ahead, and make_soup() still waits out the crawl-delay before each fetch, so pages are requested no faster than before
+
+    Callers that might stop partway through should close the generator (e.g. with contextlib.closing) so that a page still waiting on the crawl-delay doesn't get fetched anyway
+    """
+    pool = ThreadPoolExecutor(max_workers=1)
+    stop = Event()
+    try:
+        pending = None
+        for url in urls:
+            # Queue up this page before handing back the previous one
+            prev, pending = pending, (url, pool.submit(make_soup, url, stop))
+            if prev:
+                yield prev[0], prev[1].result()
+        if pending:
+            yield pending[0], pending[1].result()
+    finally:
+        # Don't fetch anything else if the caller stopped early
+        # (A fetch that's still waiting on the crawl-delay gets woken up and skipped, so exiting doesn't hang on it)
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
 
 
 # Process sections within a single page
@@ -143,9 +236,11 @@ def process_list_page(soup, src: str, all_sections: list) -> None:
     page_sections = soup.select(".node-main, .node-main-alt")
     for sec_soup in page_sections:
         # Log progress to console
-        rank, taxon = get_taxon(sec_soup)
+        # (The breadcrumbs get used several times below, so only search for them once)
+        taxon_tag = _TAXON_LINK.select_one(sec_soup)
+        rank, taxon = get_taxon(sec_soup, taxon_tag)
         # Italicize genera, species, and subspecies
-        if re.match('genus|species', rank):
+        if rank in _ITALIC_RANKS:
             rich_taxon = '[i]' + taxon + '[/i]'
             taxon = '<i>' + taxon + '</i>'
         else: 
@@ -153,33 +248,34 @@ def process_list_page(soup, src: str, all_sections: list) -> None:
         print(f"--------\nScanning page {page} submissions for '{rich_taxon}'...\n--------")
 
         # Check if this section represents a new taxon or another chunk of the previous section
-        breadcrumbs_text = sec_soup.find(class_="bgpage-roots").get_text()
-        if not all_sections or breadcrumbs_text != all_sections[-1]['title']:
-            # Last link in section breadcrumbs = this taxon's own record list
-            taxon_url = sec_soup.find(class_="bgpage-roots").find_all("a")[-1]["href"]
+        # Last link in section breadcrumbs = this taxon's own record list, which identifies the taxon more cheaply than the full breadcrumb text
+        taxon_url = taxon_tag["href"]
+        if not all_sections or taxon_url != all_sections[-1]['own_page']:
+            breadcrumbs_text = taxon_tag.parent.get_text()
             # Current url = position in parent's record list
             # Start a new section
             secdict = dict(title=breadcrumbs_text, rank=rank, taxon=taxon,
                            own_page=taxon_url, parent_page=src, records=[])
             all_sections.append(secdict)
         
-        for item in sec_soup.find_all("a", recursive=False):
-            record_url = item.get('href')
-            print(f"Checking [i cyan]{record_url}")
-            sleep(9)
-
-            soup = make_soup(record_url)
-            record = parse_record(soup)
-            all_sections[-1]['records'].append(record)
-            
-            if not record['comments']:
-                print("> No comments found")
-            else:
-                log_comments(record['comments'], record['url'], verbose=args.verbose)
-            
-            args.imgcount -= 1
-            if args.imgcount == 0:
-                exit(0)
+        record_urls = [item.get('href') for item in sec_soup.find_all("a", recursive=False)]
+        # Don't prefetch anything past the image limit
+        if args.imgcount > 0:
+            record_urls = record_urls[:args.imgcount]
+        with closing(prefetch_soups(record_urls)) as soups:
+            for record_url, soup in soups:
+                print(f"Checking [i cyan]{record_url}")
+                record = parse_record(soup)
+                all_sections[-1]['records'].append(record)
+                
+                if not record['comments']:
+                    print("> No comments found")
+                else:
+                    log_comments(record['comments'], record['url'], verbose=args.verbose)
+                
+                args.imgcount -= 1
+                if args.imgcount == 0:
+                    exit(0)
 
 
 def validate_page(soup):
@@ -189,25 +285,26 @@ def validate_page(soup):
         raise InvalidResponse("[magenta]Hmm, this doesn't look like a guide page!\nI need a starting point in the Images tab for a particular type of bug — something that looks like this: 'https://bugguide.net/node/view/9137/bgimage'")
     
     # If current tab is "Images", great, we're all set
-    img_tab = menubar.find(string="Images").parent
-    if img_tab.name != 'a' and img_tab['class'].count("guide-menubar-selected"):
+    # (The selected tab is plain text rather than a link)
+    selected_tab = _SELECTED_TAB.select_one(menubar)
+    if selected_tab and selected_tab.name != 'a' and selected_tab.get_text(strip=True) == "Images":
         return soup
     
     # Any unexpected URLs that made it this far are part of the guide for a specific taxon, just the wrong part
 
     # Pull the taxon name from the page breadcrumbs for more specific error messaging, since we're already here
     rank, taxon = get_taxon(soup)
-    if 'genus' in rank or 'species' in rank:
+    if rank in _ITALIC_RANKS:
         taxon = '[i]' + taxon + '[/i]'
 
     # If no tab is currently selected, this is an individual record page
-    if not menubar.find(class_="guide-menubar-selected"):
+    if not selected_tab:
         print(f"URL is for a record in {rank} [b]{taxon}[/b]")
     # Otherwise some other tab (i.e. "Info") is selected
     else:
         print(f"URL is for another guide page in {rank} [b]{taxon}[/b]")
     
-    correct_url = img_tab["href"]
+    correct_url = _IMG_TAB_LINK.select_one(menubar)["href"]
     confirm = Confirm.ask(f"Do you want me to start on page 1 of the images for this taxon? ({correct_url})")
     if confirm:
         return make_soup(correct_url)
@@ -230,11 +327,11 @@ class URLPrompt(Prompt):
             print(f"[magenta i]Sorry, I don't know how to read the beta site; switching to '{url}' ...")
 
         # Is this a BugGuide URL but not part of the Guide™?
-        if not re.search("bugguide\.net/node/view/\d+", url):
+        if not _GUIDE_RE.search(url):
             raise InvalidResponse("[magenta][i]This doesn't look like a guide page![/i] I need a starting point in the Images tab for a particular type of bug — something that looks like this: 'https://bugguide.net/node/view/9137/bgimage'")
 
         # Is this a URL for one of the other Guide tabs? (excluding "Info," which has no suffix and so can't be identified by URL alone)
-        wrong_tab = re.search("bugguide\.net/node/view/\d+/(tree|bgpage|bglink|bgref|data)", url)
+        wrong_tab = _WRONG_TAB_RE.search(url)
         if wrong_tab:
             # If so, it can be corrected without fetching the wrong page first
             url = url[:wrong_tab.start(1)] + "bgimage"
@@ -244,7 +341,7 @@ class URLPrompt(Prompt):
         try:
             soup = make_soup(url)
         except Exception as err:
-            raise InvalidResponse("[magenta][i]I ran into a problem loading this page: [/i]" + err.args[0])
+            raise InvalidResponse("[magenta][i]I ran into a problem loading this page: [/i]" + str(err))
 
         soup = validate_page(soup)
         if not soup: # User wants to try a different URL
@@ -287,7 +384,7 @@ def import_taxon(cfg):
         pager_end = pager.contents[-1].a
         if pager_end: # Somewhere in the middle, final page num may not be visible
             end_url = pager.get("href")
-            end_count = int(re.search("(from=)(\d+)$", end_url).group(2))
+            end_count = int(_PAGER_FROM_RE.search(end_url).group(2))
             tot_pages = ceil(end_count / 24 + 1)
         else: # On the last page
             tot_pages = start
@@ -357,7 +454,7 @@ def import_taxon(cfg):
                 if args.pgcount == 0:
                     exit(0)
                 # Check if there's another page to do
-                next_arrow = soup.find(alt="next page")
+                next_arrow = _NEXT_PAGE.select_one(soup)
                 url = next_arrow and next_arrow.parent.get('href')
         except KeyboardInterrupt:
             print("\n[magenta]Ending scan...")
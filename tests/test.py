@@ -1,12 +1,37 @@
+from hashlib import sha1
 from itertools import product
+from os import makedirs, replace
+from tempfile import NamedTemporaryFile
 from traceback import print_exception
 from __main__ import *
 from rich.prompt import Prompt
 from rich.live import Live
 
-def make_test_soup(url):
-    html = urlopen(url).read().decode("utf-8")
-    return BeautifulSoup(html, "html.parser")
+
+# Accepted answers at the "Continue testing?" prompt ('p' is handled separately, since it re-prompts)
+_CONTINUE_CMDS = frozenset(['y', 'n'])
+
+
+def cached_test_soup(url):
+    """Fetches and parses a test page, keeping a copy of each page on disk so that reruns don't need to download it again"""
+    cache_file = f"tests/.soup_cache/{sha1(url.encode()).hexdigest()}.html"
+    if exists(cache_file):
+        with open(cache_file, "rb") as f:
+            html = f.read()
+    else:
+        # (Test pages count against the crawl-delay just like the scraper's own fetches)
+        wait_for_crawl_delay()
+        resp = session.get(url, timeout=30)
+        # Don't cache error pages
+        resp.raise_for_status()
+        html = resp.content
+        makedirs("tests/.soup_cache", exist_ok=True)
+        # Write to a temp file first so that an interrupted write can't leave a truncated page in the cache
+        with NamedTemporaryFile("wb", dir="tests/.soup_cache", suffix=".tmp", delete=False) as f:
+            f.write(html)
+        replace(f.name, cache_file)
+    # (Only parse the part of the page that the real scraper reads)
+    return BeautifulSoup(html, "lxml", parse_only=SoupStrainer(class_="col2"), from_encoding="utf-8")
 
 
 with Live():
@@ -36,7 +61,8 @@ def test_comment_processing():
         "screen": (False, True),
         "ignore_moves": (None, "always", "nochat"),
     }
-    configs = list(product(*options.values()))
+    # (Screen mode prints the comment text regardless, so skip verbose + screen; it filters the same as screen alone)
+    configs = (cfg for cfg in product(*options.values()) if not (cfg[0] and cfg[1]))
 
     # Simple data structure to emulate ArgumentParser's Namespace class, in place of real CL args
     class Config:
@@ -48,36 +74,48 @@ def test_comment_processing():
 
     global args
     # Set up template engine
-    env = jin.Environment(loader=jin.FileSystemLoader("templates/"))
-    template = env.get_template("comments.html")
+    template = template_env.get_template("comments.html")
 
-    # Load all the soups once, then reuse the parse tree with each config
+    # Load and parse all the records once, then reuse the parsed data with each config
     print("(Making soup...)")
-    soups = [(url, make_test_soup(url)) for url in cases.values()]
+    soups = [cached_test_soup(url) for url in cases.values()]
+    parsed = [(url, parse_record(soup)) for url, soup in zip(cases.values(), soups)]
 
-    for url, soup in soups:
-        # Process the record using each config
+    # Process every record using each config; each config's results get their own section in the HTML output, headed by the config settings
+    context = dict(header=dict(html="Comment processing test", plain="Comment processing test"),
+                   parent_rank=None, start_url="", sections=[])
+    try:
         for cfg in configs:
-            with open(f"tests/test.html", "w", encoding="utf-8") as f:
-                args = Config(*cfg)
-                records = []
+            args = Config(*cfg)
+            section = dict(title=f"(verbose, screen, ignore_moves) = {cfg}", rank="section", taxon="",
+                           own_page="", parent_page="", records=[])
+            context["sections"].append(section)
+            for url, base_rec in parsed:
                 print(f"\n[cyan]With...[/cyan]\n  (verbose, screen, ignore_moves) = {cfg}\n  '{url}'\n")
                 try:
-                    rec = filter_record(soup)
-                    if rec: records.append(rec)
+                    # Filtering replaces the comment list, so give each config its own shallow copy
+                    rec = filter_record(dict(base_rec, comments=list(base_rec['comments'])))
+                    if rec: section["records"].append(rec)
                 except Exception as e:
                     print(f"[dark_orange]Error: {e}[/dark_orange]\n  (verbose, screen, ignore_moves) = {cfg}\n  '{url}'")
                     print_exception(e)
-                
-                f.write(template.render({"records": records}))
 
-            print("\n[cyan]Continue testing? y/n [cyan]>>> ", end="")
-            cmd = input().strip().lower()
-            while cmd not in ['y', 'n']:
-                print("Unrecognized command", "[bold]>>> ", sep="\n", end="")
+                print("\n[cyan]Continue testing? y/n (or p to preview this config's HTML) [cyan]>>> ", end="")
                 cmd = input().strip().lower()
-            if cmd == 'n':
-                exit(0)
+                while cmd not in _CONTINUE_CMDS:
+                    if cmd == 'p':
+                        with open(f"tests/test.html", "w", encoding="utf-8") as f:
+                            template.stream(dict(context, sections=[section])).dump(f)
+                        print("Preview saved to 'tests/test.html'", "[bold]>>> ", sep="\n", end="")
+                    else:
+                        print("Unrecognized command", "[bold]>>> ", sep="\n", end="")
+                    cmd = input().strip().lower()
+                if cmd == 'n':
+                    exit(0)
+    finally:
+        # Render every config's results once, however testing ended
+        with open(f"tests/test.html", "w", encoding="utf-8") as f:
+            template.stream(context).dump(f)
 
 # ----------------------------------------------------------
 url_check_cases = [